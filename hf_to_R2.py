@@ -1,23 +1,41 @@
 import os
 import time
-import pandas as pd
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
-import s3fs
-from datasets import load_dataset, disable_progress_bar
+from datasets import load_dataset, load_from_disk, disable_progress_bar
 from huggingface_hub import hf_api
 from datetime import datetime
-import json
+import orjson
+import xxhash
 from dotenv import load_dotenv
 import argparse
 import pathlib
-import subprocess
 
 load_dotenv()
 
 disable_progress_bar()
 
-BROTLI_MAX_COMPRESSION_LEVEL = 11
+DEFAULT_COMPRESSION = "zstd"
+DEFAULT_COMPRESSION_LEVEL = 3
+
+# Heavy months are split into several row groups so readers can parallelize within a file
+ROW_GROUP_SIZE = 100_000
+
+MB = 1024 * 1024
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    max_concurrency=16,
+    use_threads=True,
+)
+UPLOAD_MAX_WORKERS = 8
 
 
 # Set up argument parser
@@ -34,6 +52,24 @@ parser.add_argument(
     action="store_true",
     help="Force sync all files to R2 even if they exist",
 )
+parser.add_argument(
+    "--keep-snapshot",
+    action="store_true",
+    help="Save a local snapshot of each dataset to reuse while it is unchanged on the Hub "
+    "(only useful when the cache directory persists between runs)",
+)
+parser.add_argument(
+    "--compression",
+    default=DEFAULT_COMPRESSION,
+    help=f"Parquet compression codec (default: {DEFAULT_COMPRESSION})",
+)
+parser.add_argument(
+    "--compression-level",
+    type=int,
+    default=None,
+    help=f"Parquet compression level (default: {DEFAULT_COMPRESSION_LEVEL} for "
+    f"{DEFAULT_COMPRESSION}, the codec's own default otherwise)",
+)
 args = parser.parse_args()
 
 # Cache directory
@@ -59,24 +95,37 @@ if (
     )
 
 
+HF_API = hf_api.HfApi(token=HF_TOKEN)
+
+
 def get_r2_client():
     return boto3.client(
         "s3",
         endpoint_url=R2_ENDPOINT_URL,
         aws_access_key_id=R2_ACCESS_KEY_ID,
         aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=Config(signature_version="s3v4"),
+        config=Config(
+            signature_version="s3v4",
+            # Enough connections for every concurrent multipart upload thread
+            max_pool_connections=UPLOAD_MAX_WORKERS * UPLOAD_TRANSFER_CONFIG.max_concurrency,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        ),
     )
 
 
+# boto3 clients are thread-safe; share one so connections and credentials are reused
+R2_CLIENT = get_r2_client()
+
+
 def get_r2_filesystem():
-    return s3fs.S3FileSystem(
-        client_kwargs={
-            "endpoint_url": R2_ENDPOINT_URL,
-        },
-        key=R2_ACCESS_KEY_ID,
-        secret=R2_SECRET_ACCESS_KEY,
-        config_kwargs={"signature_version": "s3v4"},
+    # Native Arrow filesystem: reads/writes stay in C++ instead of calling back into Python
+    return pafs.S3FileSystem(
+        endpoint_override=R2_ENDPOINT_URL,
+        access_key=R2_ACCESS_KEY_ID,
+        secret_key=R2_SECRET_ACCESS_KEY,
+        region="auto",
+        scheme="https",
     )
 
 
@@ -89,97 +138,253 @@ def get_cache_file_path(repo_name, month):
     return os.path.join(CACHE_DIR, f"{repo_name}_{month}.parquet")
 
 
-def sync_files_to_r2(repo_name):
-    # Create a temporary rclone config file
-    rclone_config_path = os.path.join(CACHE_DIR, "rclone.conf")
-    with open(rclone_config_path, "w") as f:
-        f.write(
-            f"""[r2]
-type = s3
-env_auth = true
-provider = Cloudflare
-access_key_id = {R2_ACCESS_KEY_ID}
-secret_access_key = {R2_SECRET_ACCESS_KEY}
-endpoint = {R2_ENDPOINT_URL}
-"""
-        )
+def get_dataset_last_update(repo_id):
+    return HF_API.dataset_info(repo_id).last_modified
 
-    # Source directory with the repo's cached files
-    source_dir = CACHE_DIR
 
-    # Destination path in R2
-    dest_path = f"r2:/{R2_BUCKET_NAME}/ds/{repo_name}/"
+def get_snapshot_path(repo_name, last_update):
+    # Snapshots are keyed by the dataset's last modification time on the Hub
+    return os.path.join(
+        CACHE_DIR, "snapshots", repo_name, last_update.strftime("%Y%m%dT%H%M%S")
+    )
 
-    # Build rclone command
-    if args.force_sync:
-        # When --force-sync is used, sync all files regardless of their state
-        cmd = [
-            "rclone",
-            "sync",  # sync will make destination identical to source
-            "--config",
-            rclone_config_path,
-            "--include",
-            f"{repo_name}_*.parquet",
-            "--s3-no-check-bucket",
-            "-v",
-        ]
-        print(f"Force syncing all files to R2 for {repo_name}...")
+
+def load_dataset_snapshot(repo_id, repo_name, last_update):
+    snapshot_path = get_snapshot_path(repo_name, last_update)
+    if os.path.exists(snapshot_path):
+        print(f"Dataset {repo_id} unchanged since {last_update}, using local snapshot")
+        return load_from_disk(snapshot_path)
+
+    dataset = load_dataset(repo_id, token=HF_TOKEN)
+    if not args.keep_snapshot:
+        return dataset
+
+    # Replace snapshots of older versions; save to a temporary path first so an
+    # interrupted save is never mistaken for a complete snapshot
+    shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+    tmp_path = f"{snapshot_path}.tmp"
+    dataset.save_to_disk(tmp_path)
+    os.rename(tmp_path, snapshot_path)
+    return dataset
+
+
+def get_r2_file_key(repo_name, month):
+    return f"ds/{repo_name}/{repo_name}_{month}.parquet"
+
+
+def list_r2_files(bucket_name, repo_name):
+    # A single paginated listing instead of a HEAD request per month,
+    # mapping each key to its last modified time
+    paginator = R2_CLIENT.get_paginator("list_objects_v2")
+    return {
+        obj["Key"]: obj["LastModified"]
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"ds/{repo_name}/")
+        for obj in page.get("Contents", [])
+    }
+
+
+def get_changelog_key(repo_name):
+    return f"ds/{repo_name}/changelog.json"
+
+
+def read_changelog_from_r2(bucket_name, repo_name):
+    response = R2_CLIENT.get_object(Bucket=bucket_name, Key=get_changelog_key(repo_name))
+    return orjson.loads(response["Body"].read())
+
+
+def write_changelog_to_r2(bucket_name, repo_name, changelog):
+    R2_CLIENT.put_object(
+        Bucket=bucket_name,
+        Key=get_changelog_key(repo_name),
+        Body=orjson.dumps(changelog, option=orjson.OPT_INDENT_2),
+        ContentType="application/json",
+    )
+
+
+def hash_table(table):
+    # Content hash of the Arrow data, used to skip rewriting unchanged months.
+    # Hashing the buffers of one contiguous chunk per column keeps the hash
+    # independent of how the table happens to be chunked, and skipping the
+    # validity bitmap of columns without nulls makes it independent of whether
+    # one was allocated. Buffer layouts can still differ between pyarrow
+    # versions, which only causes a one-off rewrite of unchanged months.
+    hasher = xxhash.xxh64()
+    hasher.update(table.schema.serialize())
+    for column in table.combine_chunks().columns:
+        for chunk in column.chunks:
+            buffers = chunk.buffers()
+            if chunk.null_count == 0:
+                buffers = buffers[1:]
+            for buffer in buffers:
+                if buffer is not None:
+                    hasher.update(buffer)
+    return hasher.hexdigest()
+
+
+def normalize_dates(table):
+    # Convert dates to timestamps, normalized to midnight to get day-level precision
+    dates = table["date"]
+    if pa.types.is_date(dates.type):
+        # Already day-level, so only the type changes and no flooring pass is needed
+        dates = pc.cast(dates, pa.timestamp("ns"))
     else:
-        # Default behavior: only copy files that don't exist or are larger
-        cmd = [
-            "rclone",
-            "copy",  # copy will only transfer missing/changed files
-            "--config",
-            rclone_config_path,
-            "--include",
-            f"{repo_name}_*.parquet",
-            "--s3-no-check-bucket",
-            "--update",  # Skip files that are newer on the destination
-            "-v",
-        ]
-        print(f"Syncing only new or larger files to R2 for {repo_name}...")
-
-    # Add source and destination
-    cmd.extend([source_dir, dest_path])
-
-    # Execute the command
+        if not pa.types.is_timestamp(dates.type):
+            dates = pc.cast(dates, pa.timestamp("ns"))
+        dates = pc.floor_temporal(dates, unit="day")
+    return table.set_column(table.schema.get_field_index("date"), "date", dates)
+
+
+def cast_nullable_integers(table):
+    # The pandas conversion this script used to do stored integer columns containing
+    # nulls as float64; keep the published schema the same
+    for index, field in enumerate(table.schema):
+        column = table.column(index)
+        if pa.types.is_integer(field.type) and column.null_count > 0:
+            table = table.set_column(index, field.name, pc.cast(column, pa.float64()))
+    return table
+
+
+def write_month_file(table, path, compression, compression_level):
+    # One Parquet file per month keeps the published ds/{repo_name}/{repo_name}_{month}.parquet
+    # layout, so months are written individually rather than as a hive-partitioned dataset
+
+    # Only the default codec gets a default level; codecs such as snappy reject any level
+    if compression_level is None and compression == DEFAULT_COMPRESSION:
+        compression_level = DEFAULT_COMPRESSION_LEVEL
+
+    # Write to a temporary file first, so a month that fails partway never leaves a
+    # truncated but readable file behind for the sync step to upload
+    tmp_path = f"{path}.tmp"
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        print(f"Sync completed successfully for {repo_name}")
-        print(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error syncing files: {e}")
-        print(f"Command output: {e.stdout}")
-        print(f"Command error: {e.stderr}")
+        with pq.ParquetWriter(
+            tmp_path,
+            table.schema,
+            compression=compression,
+            compression_level=compression_level,
+            use_dictionary=True,
+            data_page_size=1 << 20,
+            write_statistics=True,
+            write_batch_size=64 * 1024,
+        ) as writer:
+            # write_table slices across chunk boundaries, so row groups are
+            # ROW_GROUP_SIZE rows regardless of how the month table is chunked
+            writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        os.replace(tmp_path, path)
     finally:
-        # Clean up the temporary config file
-        if os.path.exists(rclone_config_path):
-            os.remove(rclone_config_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def upload_file_to_r2(bucket_name, file_key, path):
+    R2_CLIENT.upload_file(str(path), bucket_name, file_key, Config=UPLOAD_TRANSFER_CONFIG)
+
+
+def sync_files_to_r2(bucket_name, repo_name, existing_files, uploaded_keys):
+    # Local cache files for this repo, keyed by their destination in R2, skipping
+    # the ones already uploaded during this run
+    local_files = {
+        f"ds/{repo_name}/{path.name}": path
+        for path in pathlib.Path(CACHE_DIR).glob(f"{repo_name}_*.parquet")
+        if f"ds/{repo_name}/{path.name}" not in uploaded_keys
+    }
+
+    if args.force_sync:
+        # When --force-sync is used, upload all files regardless of their state
+        files_to_upload = local_files
+        print(f"Force syncing all files to R2 for {repo_name}...")
+    else:
+        # Default behavior: only upload files that are missing or newer than in R2
+        files_to_upload = {
+            key: path
+            for key, path in local_files.items()
+            if key not in existing_files
+            or path.stat().st_mtime > existing_files[key].timestamp()
+        }
+        print(f"Syncing only new or updated files to R2 for {repo_name}...")
+
+    failed_keys = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(upload_file_to_r2, bucket_name, key, path): key
+            for key, path in files_to_upload.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+                print(f"Uploaded {key}")
+            except Exception as e:
+                print(f"Error uploading {key}: {e}")
+                failed_keys.append(key)
+
+    if failed_keys:
+        print(f"Sync finished with {len(failed_keys)} failed uploads for {repo_name}")
+    else:
+        print(
+            f"Sync completed successfully for {repo_name}, uploaded {len(files_to_upload)} files"
+        )
+
+    return failed_keys
 
 
-def process_dataset_by_month(repo_id, bucket_name, compression="brotli"):
+def process_dataset_by_month(
+    repo_id,
+    bucket_name,
+    compression=DEFAULT_COMPRESSION,
+    compression_level=None,
+):
     repo_name = repo_id.split("/")[-1].lower()
 
+    existing_files = list_r2_files(bucket_name, repo_name)
+    print(f"Found {len(existing_files)} existing files in R2 for {repo_name}")
+
+    changelog = {}
+    if get_changelog_key(repo_name) in existing_files:
+        changelog = read_changelog_from_r2(bucket_name, repo_name)
+    month_hashes = changelog.get("month_hashes", {})
+
+    # Skip the whole dataset when nothing changed on the Hub since the last complete run
+    last_update = get_dataset_last_update(repo_id)
+    last_processed = (
+        datetime.fromisoformat(changelog["last_update"])
+        if "last_update" in changelog
+        else None
+    )
+    if (
+        last_processed
+        and last_processed >= last_update
+        and not args.overwrite_cache
+        and not args.force_sync
+    ):
+        print(f"Dataset {repo_id} unchanged since {last_processed}, skipping")
+        return
+
     print(f"Loading dataset {repo_id}...")
     start_time = time.time()
-    dataset = load_dataset(repo_id, token=HF_TOKEN)
+    dataset = load_dataset_snapshot(repo_id, repo_name, last_update)
     print(f"Dataset loaded in {time.time() - start_time:.2f} seconds")
 
-    print("Converting to pandas DataFrame...")
+    print("Preparing Arrow table...")
     start_time = time.time()
 
-    # Convert to DataFrame
-    df = dataset["train"].to_pandas()
+    # Work on the underlying Arrow table directly instead of converting to pandas;
+    # drop the HF schema metadata since the date column type changes below
+    table = dataset["train"].data.table.replace_schema_metadata()
+    table = normalize_dates(table)
+    table = cast_nullable_integers(table)
+    print(f"Preparation completed in {time.time() - start_time:.2f} seconds")
 
-    # Convert dates to datetime, normalize to midnight to get day-level precision
-    df["date"] = pd.to_datetime(df["date"]).dt.normalize()
-    print(f"Conversion completed in {time.time() - start_time:.2f} seconds")
-
-    # Extract month identifier from dates
-    df["month_id"] = df["date"].dt.strftime("%Y.%m")
+    # Extract month identifier from dates as year * 100 + month integers
+    month_keys = pc.add(
+        pc.multiply(pc.year(table["date"]), 100), pc.month(table["date"])
+    )
 
-    # Get unique months and sort them for ordered processing
-    months = sorted(df["month_id"].unique())
+    # Get unique months and sort them for ordered processing, mapping each
+    # "YYYY.MM" month to its integer key; only the unique keys are formatted
+    months = {
+        f"{key // 100}.{key % 100:02d}": key
+        for key in sorted(pc.unique(month_keys).to_pylist())
+    }
     print(f"Found {len(months)} unique months in the dataset")
 
     # Calculate the most recent six calendar months based on current date
@@ -188,54 +393,137 @@ def process_dataset_by_month(repo_id, bucket_name, compression="brotli"):
 
     # Get the current month and previous five months (six months total)
     for i in range(6):
-        # Calculate month offset from current date
-        month_date = current_date.replace(day=1) - pd.DateOffset(months=i)
-        recent_month = month_date.strftime("%Y.%m")
+        # Calculate month offset from current date using a zero-based month count
+        month_index = current_date.year * 12 + current_date.month - 1 - i
+        recent_month = f"{month_index // 12}.{month_index % 12 + 1:02d}"
         recent_months.append(recent_month)
 
     print(f"Current date: {current_date.strftime('%Y-%m-%d')}")
     print(f"Will force update data from recent months: {recent_months}")
 
+    months_to_process = []
     for month in months:
-        cache_file = get_cache_file_path(repo_name, month)
-
-        # Filter data for the current month using the pre-calculated month_id
-        month_df = df[df["month_id"] == month]
-
-        # Process if it's a recent month or if overwrite-cache flag is set
-        if args.overwrite_cache or month in recent_months:
-            print(
-                f"Processing month {month}"
-                + (
-                    ", overwrite-cache flag is set"
-                    if args.overwrite_cache
-                    else ", it's a recent month"
-                )
-            )
-            # Save to cache
-            print(f"Saving {month} to cache...")
-            start_time = time.time()
-
-            # Drop temporary month_id column before saving
-            save_df = month_df.drop(columns=["month_id"])
-
-            save_df.to_parquet(
-                cache_file,
-                engine="pyarrow",
-                compression=compression,
-                compression_level=BROTLI_MAX_COMPRESSION_LEVEL,
-                index=False,
-            )
-            print(
-                f"Saved {len(month_df)} records for {month} to cache in {time.time() - start_time:.2f} seconds"
-            )
+        # Process if overwrite-cache flag is set, it's a recent month or it's missing from R2
+        if args.overwrite_cache:
+            reason = "overwrite-cache flag is set"
+        elif month in recent_months:
+            reason = "it's a recent month"
+        elif get_r2_file_key(repo_name, month) not in existing_files:
+            reason = "it's missing from R2"
         else:
             print(
-                f"Skipping month {month} because it's not in recent months and overwrite-cache is {args.overwrite_cache}"
+                f"Skipping month {month} because it's not in recent months, already in R2 and overwrite-cache is {args.overwrite_cache}"
             )
+            continue
+        print(f"Processing month {month}, {reason}")
+        months_to_process.append(month)
+
+    # Drop rows of skipped months before grouping, so only processed months get sorted
+    if len(months_to_process) < len(months):
+        selected_keys = pa.array(
+            [months[month] for month in months_to_process], month_keys.type
+        )
+        mask = pc.is_in(month_keys, value_set=selected_keys)
+        table = table.filter(mask)
+        month_keys = month_keys.filter(mask)
+
+    # Group rows by month in a single pass: a stable sort on the month keys makes
+    # each month a contiguous run of row indices, in their original order
+    order = pc.sort_indices(month_keys)
+    month_rows = {}
+    offset = 0
+    for entry in pc.value_counts(month_keys.take(order)).to_pylist():
+        key, count = entry["values"], entry["counts"]
+        month_rows[key] = order.slice(offset, count)
+        offset += count
+
+    def write_one_month(month):
+        cache_file = get_cache_file_path(repo_name, month)
+        start_time = time.time()
+
+        # Gather the current month's rows using the pre-calculated grouping
+        month_table = table.take(month_rows[months[month]])
+
+        # Skip months whose data is identical to what was last uploaded, unless
+        # the files are explicitly being rewritten or re-uploaded
+        month_hash = hash_table(month_table)
+        if (
+            not args.overwrite_cache
+            and not args.force_sync
+            and month_hashes.get(month) == month_hash
+            and get_r2_file_key(repo_name, month) in existing_files
+        ):
+            print(f"Month {month} is unchanged since the last upload, skipping")
+            return month, None
+
+        write_month_file(month_table, cache_file, compression, compression_level)
+        print(
+            f"Saved {month_table.num_rows} records for {month} to cache in {time.time() - start_time:.2f} seconds"
+        )
+
+        # Upload right away so the month survives a killed run; once in R2 it is
+        # skipped by the next run unless it's a recent month
+        file_key = get_r2_file_key(repo_name, month)
+        try:
+            upload_file_to_r2(bucket_name, file_key, cache_file)
+            uploaded_keys.add(file_key)
+            print(f"Uploaded {file_key}")
+        except Exception as e:
+            # Left for sync_files_to_r2 to retry after all months are written
+            print(f"Error uploading {file_key}: {e}")
+        return month, month_hash
+
+    new_month_hashes = {}
+    uploaded_keys = set()
+    completed = False
+    try:
+        if months_to_process:
+            # Months are independent; Arrow releases the GIL while compressing and writing
+            print(f"Saving {len(months_to_process)} months to cache...")
+            max_workers = min(len(months_to_process), (os.cpu_count() or 1) * 2)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(write_one_month, month)
+                    for month in months_to_process
+                ]
+                for future in as_completed(futures):
+                    try:
+                        month, month_hash = future.result()
+                    except Exception:
+                        # Stop queued months, then wait for the running ones and keep
+                        # the hashes of every month that was written
+                        executor.shutdown(cancel_futures=True)
+                        for other in futures:
+                            if not other.cancelled() and other.exception() is None:
+                                other_month, other_hash = other.result()
+                                if other_hash is not None:
+                                    new_month_hashes[other_month] = other_hash
+                        raise
+                    if month_hash is not None:
+                        new_month_hashes[month] = month_hash
+        completed = True
+    finally:
+        # Retry failed month uploads and upload any other pending cache files,
+        # then record what was written even if a month failed
+        failed_keys = sync_files_to_r2(
+            bucket_name, repo_name, existing_files, uploaded_keys
+        )
+
+        # Record hashes only for months that made it to R2
+        month_hashes.update(
+            {
+                month: month_hash
+                for month, month_hash in new_month_hashes.items()
+                if get_r2_file_key(repo_name, month) not in failed_keys
+            }
+        )
+        changelog["month_hashes"] = month_hashes
+
+        # Only a fully written and uploaded run marks this dataset version as done
+        if completed and not failed_keys:
+            changelog["last_update"] = last_update.isoformat()
+        write_changelog_to_r2(bucket_name, repo_name, changelog)
 
-    # Sync all files to R2 using rclone
-    sync_files_to_r2(repo_name)
     print("Processing completed successfully!")
 
 
@@ -249,7 +537,12 @@ def main():
         "paperswithbacktest/Forex-Daily-Price",
         "paperswithbacktest/Commodities-Daily-Price",
     ]:
-        process_dataset_by_month(repo_id, R2_BUCKET_NAME)
+        process_dataset_by_month(
+            repo_id,
+            R2_BUCKET_NAME,
+            compression=args.compression,
+            compression_level=args.compression_level,
+        )
 
 
 if __name__ == "__main__":